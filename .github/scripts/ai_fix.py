@@ -1,10 +1,20 @@
-import glob
+import hashlib
 import json
 import os
+import random
 import re
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is used when orjson is missing
+    orjson = None
 
 
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -21,11 +31,40 @@ OPENAI_REVIEW_MODEL = os.environ.get("OPENAI_REVIEW_MODEL", OPENAI_MODEL)
 OPENAI_API_URL = os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1/responses")
 OPENAI_REASONING_EFFORT = os.environ.get("OPENAI_REASONING_EFFORT", "").strip()
 OPENAI_MAX_PROMPT_CHARS = int(os.environ.get("OPENAI_MAX_PROMPT_CHARS", "120000"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+OPENAI_STREAM = os.environ.get("OPENAI_STREAM", "true").strip().lower() not in ("0", "false", "no")
+
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# (connect, read) timeouts: fail fast on unreachable hosts, allow slow generations.
+OPENAI_TIMEOUT = (5, 90)
+GITHUB_TIMEOUT = (5, 30)
 
 CONTEXT_EXTENSIONS = ("py", "js", "go", "ts", "yml", "yaml", "html", "sh", "java", "cpp")
 SKIP_PATH_PARTS = (".git", "node_modules", "venv", "__pycache__", "dist", "build")
 MAX_CONTEXT_FILES = int(os.environ.get("MAX_CONTEXT_FILES", "15"))
 MAX_CONTEXT_FILE_SIZE = int(os.environ.get("MAX_CONTEXT_FILE_SIZE", "8000"))
+CONTEXT_WINDOW_LINES = int(os.environ.get("CONTEXT_WINDOW_LINES", "50"))
+AI_FIX_CACHE_DIR = os.environ.get("AI_FIX_CACHE_DIR", ".ai_fix_cache")
+# Entries older than this are ignored; 0 disables expiry. A day covers a
+# later "/apply" run restoring the same issue's cache.
+AI_FIX_CACHE_TTL = int(os.environ.get("AI_FIX_CACHE_TTL", "86400"))
+
+_CODE_BLOCK_RE = re.compile(r"```[a-zA-Z0-9_-]*[ \t]*\n?(.*?)\n?```", re.DOTALL)
+# Timestamps, PIDs and addresses that differ between reports of the same
+# failure; they are masked out of the issue text in the cache key only,
+# never out of the prompt. Kept in sync with universal_fix._VOLATILE_RE.
+_VOLATILE_RE = re.compile(
+    r"\d{4}[-/]\d{2}[-/]\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?"
+    r"|\b\d{2}/\d{2} \d{2}:\d{2}\b"
+    r"|\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b"
+    r"|\b(?:pid|PID)[=: ]\s*\d+"
+    r"|\b0x[0-9a-fA-F]{6,}\b"
+)
+# "path:line" and traceback 'File "path", line N' references in the issue.
+_CITATION_RE = re.compile(r'([\w./\\-]*\w\.\w+)(?:",\s*line\s+|:)(\d+)')
+_APPLY_COMMAND = "/apply"
+_APPLY_CHOICES = frozenset({"A", "B", "HYBRID"})
+_APPLY_COMMAND_RE = re.compile(r"/apply\s+(A|B|HYBRID)", re.IGNORECASE)
 
 CODEX_SYSTEM_PROMPT = (
     "You are Codex, OpenAI's coding agent. "
@@ -34,6 +73,44 @@ CODEX_SYSTEM_PROMPT = (
 )
 
 
+def _build_session() -> requests.Session:
+    """Pooled keep-alive session shared by every model call in this run."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+_SESSION = _build_session()
+
+
+def _json_dumps(data: object) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def _json_loads(data: Union[str, bytes]) -> object:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _strip_code_fence(text: str) -> str:
+    """Return the body of the first fenced block, or the text minus stray fences."""
+    match = _CODE_BLOCK_RE.search(text)
+    if match:
+        return match.group(1).strip()
+
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+    if text.endswith("```"):
+        text = text[:-3]
+    return text.strip()
+
+
 def robust_json_decode(text: Optional[str]) -> Optional[Dict[str, object]]:
     """Decode model output into a JSON object."""
     if not text:
@@ -41,8 +118,7 @@ def robust_json_decode(text: Optional[str]) -> Optional[Dict[str, object]]:
 
     candidates = [text]
 
-    cleaned = re.sub(r"```[a-zA-Z0-9_-]*\n?", "", text)
-    cleaned = re.sub(r"\n?```", "", cleaned).strip()
+    cleaned = _strip_code_fence(text)
     if cleaned != text:
         candidates.append(cleaned)
 
@@ -62,15 +138,88 @@ def robust_json_decode(text: Optional[str]) -> Optional[Dict[str, object]]:
     return None
 
 
-def get_context() -> str:
-    """Collect a bounded amount of repository context for the model prompt."""
-    context_parts: List[str] = []
+# Files that reach the prompt only as an excerpt; apply_code refuses to
+# overwrite them, since the model never saw their full contents.
+_EXCERPTED_PATHS = set()
+
+
+def _path_parts(path: str) -> Tuple[str, ...]:
+    return tuple(part for part in path.replace("\\", "/").split("/") if part not in ("", "."))
+
+
+def _issue_citations() -> List[Tuple[Tuple[str, ...], int]]:
+    return [(_path_parts(match.group(1)), int(match.group(2))) for match in _CITATION_RE.finditer(ISSUE_BODY)]
+
+
+def _cited_lines(path: str, citations: List[Tuple[Tuple[str, ...], int]], ambiguous: set) -> List[int]:
+    """Line numbers the issue cites for this file (tracebacks and file:line refs).
+
+    A citation matches when one path is a suffix of the other, e.g. the
+    server's /home/pb/ai_fix.py and the checkout's pb/ai_fix.py. A bare
+    file name only counts when no other candidate file shares it.
+    """
+    parts = _path_parts(path)
+    lines: List[int] = []
+    for cited, line in citations:
+        common = 0
+        for a, b in zip(reversed(cited), reversed(parts)):
+            if a != b:
+                break
+            common += 1
+        if not common or common < min(len(cited), len(parts)):
+            continue
+        if common == 1 and parts[-1] in ambiguous:
+            continue
+        lines.append(line)
+    return lines
+
+
+def _error_window(path: str, content: str, cited: List[int]) -> Optional[str]:
+    """Excerpt an oversized file around the lines the issue points at.
+
+    Large files are otherwise left out of the prompt entirely; sending only
+    the error-proximate window keeps the relevant code without paying for
+    the whole file. The excerpt is marked read-only in the prompt.
+    """
+    if not cited:
+        return None
+
+    lines = content.splitlines()
+    start = max(0, min(cited) - 1 - CONTEXT_WINDOW_LINES)
+    end = min(len(lines), max(cited) + CONTEXT_WINDOW_LINES)
+    excerpt = "\n".join(lines[start:end])
+    if not excerpt or len(excerpt) >= MAX_CONTEXT_FILE_SIZE:
+        return None
+
+    return f"\n--- File: {path} (EXCERPT, lines {start + 1}-{end}, read-only) ---\n{excerpt}\n"
+
+
+def _context_files() -> List[str]:
+    """Walk the tree once, never descending into hidden or skipped directories.
+
+    Hidden files are excluded, matching recursive glob semantics.
+    """
+    suffixes = tuple(f".{ext}" for ext in CONTEXT_EXTENSIONS)
     files: List[str] = []
+    for root, dirs, names in os.walk("."):
+        dirs[:] = [d for d in dirs if not d.startswith(".") and d not in SKIP_PATH_PARTS]
+        for name in names:
+            if name.endswith(suffixes) and not name.startswith("."):
+                files.append(os.path.relpath(os.path.join(root, name)))
+    return sorted(files)
 
-    for ext in CONTEXT_EXTENSIONS:
-        files.extend(glob.glob(f"**/*.{ext}", recursive=True))
 
-    for path in sorted(files):
+def get_context() -> str:
+    """Collect a bounded amount of repository context for the model prompt."""
+    context_parts: List[str] = []
+    files = _context_files()
+    citations = _issue_citations()
+    seen = set()
+    ambiguous = set()
+    for name in (os.path.basename(path) for path in files):
+        (ambiguous if name in seen else seen).add(name)
+
+    for path in files:
         if any(part in path for part in SKIP_PATH_PARTS):
             continue
         try:
@@ -79,10 +228,17 @@ def get_context() -> str:
         except Exception:
             continue
 
-        if not content or len(content) >= MAX_CONTEXT_FILE_SIZE:
+        if not content:
             continue
 
-        context_parts.append(f"\n--- File: {path} ---\n{content}\n")
+        if len(content) >= MAX_CONTEXT_FILE_SIZE:
+            window = _error_window(path, content, _cited_lines(path, citations, ambiguous))
+            if window is None:
+                continue
+            _EXCERPTED_PATHS.add(os.path.normpath(path))
+            context_parts.append(window)
+        else:
+            context_parts.append(f"\n--- File: {path} ---\n{content}\n")
         if len(context_parts) >= MAX_CONTEXT_FILES:
             break
 
@@ -127,6 +283,166 @@ def _extract_openai_text(response_json: dict) -> Optional[str]:
     return None
 
 
+def _cache_path(model: str, prompt: str) -> str:
+    # Mask volatile tokens in the issue title/body (the log excerpt) only;
+    # repository context and model output stay verbatim so that code
+    # differing only in constants or date literals never shares a key.
+    normalized = prompt
+    for issue_text in (ISSUE_BODY, ISSUE_TITLE):
+        if issue_text:
+            normalized = normalized.replace(issue_text, _VOLATILE_RE.sub("#", issue_text))
+    material = "\0".join((model, OPENAI_REASONING_EFFORT, CODEX_SYSTEM_PROMPT, normalized))
+    key = hashlib.blake2b(material.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(AI_FIX_CACHE_DIR, f"{key}.txt")
+
+
+_CACHE_STATS = {"hits": 0, "misses": 0}
+_CACHE_STATS_LOCK = threading.Lock()
+
+
+def _cache_count(outcome: str) -> None:
+    with _CACHE_STATS_LOCK:
+        _CACHE_STATS[outcome] += 1
+
+
+def _cache_get(path: str) -> Optional[str]:
+    try:
+        if AI_FIX_CACHE_TTL > 0 and time.time() - os.path.getmtime(path) > AI_FIX_CACHE_TTL:
+            return None
+        with open(path, "r", encoding="utf-8") as handle:
+            return handle.read() or None
+    except OSError:
+        return None
+
+
+def _prune_cache() -> None:
+    """Delete expired entries so the restored-and-resaved cache dir stays bounded."""
+    if AI_FIX_CACHE_TTL <= 0:
+        return
+    cutoff = time.time() - AI_FIX_CACHE_TTL
+    removed = 0
+    try:
+        with os.scandir(AI_FIX_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+    except OSError:
+        return
+    if removed:
+        print(f"Codex cache: pruned {removed} expired entr{'y' if removed == 1 else 'ies'}")
+
+
+def _cache_put(path: str, text: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        print(f"Codex cache write failed: {exc}")
+
+
+def _read_openai_stream(response: requests.Response) -> Tuple[Optional[str], bool]:
+    """Accumulate output text from a Responses API event stream.
+
+    Reading stops at the first terminal event instead of waiting for the
+    server to close the connection. The flag is True only when the stream
+    ended with response.completed, i.e. the text is a whole answer.
+    """
+    response.encoding = "utf-8"
+    texts: List[str] = []
+
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            event = _json_loads(data)
+        except ValueError:
+            continue
+        if not isinstance(event, dict):
+            continue
+
+        event_type = event.get("type")
+        if event_type in ("response.output_text.delta", "response.refusal.delta"):
+            texts.append(str(event.get("delta", "")))
+        elif event_type in ("response.completed", "response.incomplete", "response.failed"):
+            completed = event_type == "response.completed"
+            if texts:
+                return "".join(texts), completed
+            final = event.get("response")
+            if not isinstance(final, dict):
+                return None, False
+            return _extract_openai_text(final), completed and _is_complete_body(final)
+        elif event_type == "error":
+            print(f"Codex stream error: {event.get('message') or event}")
+            return None, False
+
+    return "".join(texts) or None, False
+
+
+def _is_complete_body(response_json: dict) -> bool:
+    """A finished, error-free response; anything else must not be cached."""
+    return not response_json.get("error") and response_json.get("status", "completed") == "completed"
+
+
+def _cache_result(path: str, text: str, complete: bool, expect_json: bool) -> None:
+    """Cache only whole answers; failures and truncated output are retried next run."""
+    if not complete:
+        return
+    if expect_json and robust_json_decode(text) is None:
+        return
+    _cache_put(path, text)
+
+
+def _retry_delay(response: Optional[requests.Response], attempt: int) -> float:
+    """Honor Retry-After when the server sends one, else back off exponentially."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = float(2 ** attempt)
+    # Jitter keeps the concurrent plan requests from retrying in lockstep.
+    return min(delay, 60.0) + random.uniform(0, 0.5)
+
+
+def _post_with_retry(headers: Dict[str, str], body: bytes) -> Optional[requests.Response]:
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        last_attempt = attempt == OPENAI_MAX_RETRIES
+        try:
+            response = _SESSION.post(
+                OPENAI_API_URL, headers=headers, data=body, timeout=OPENAI_TIMEOUT, stream=OPENAI_STREAM
+            )
+        except requests.exceptions.ConnectionError as exc:
+            if last_attempt:
+                print(f"Codex request failed: {exc}")
+                return None
+            delay = _retry_delay(None, attempt)
+            print(f"Codex connection failed ({exc}); retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        except Exception as exc:
+            print(f"Codex request failed: {exc}")
+            return None
+
+        if response.status_code in RETRYABLE_STATUS_CODES and not last_attempt:
+            delay = _retry_delay(response, attempt)
+            response.close()
+            print(f"Codex request got HTTP {response.status_code}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        return response
+
+    return None
+
+
 def call_codex(prompt: str, *, model: str, expect_json: bool = False) -> Optional[str]:
     if not OPENAI_API_KEY:
         print("Codex call skipped: OPENAI_API_KEY is not set.")
@@ -134,6 +450,16 @@ def call_codex(prompt: str, *, model: str, expect_json: bool = False) -> Optiona
 
     prompt = _truncate_prompt(prompt)
 
+    # Reruns of the workflow on an unchanged issue produce identical prompts;
+    # answer those from the on-disk cache instead of calling the model again.
+    cache_path = _cache_path(model, prompt)
+    cached = _cache_get(cache_path)
+    if cached:
+        _cache_count("hits")
+        print(f"Codex cache hit: {os.path.basename(cache_path)}")
+        return cached
+    _cache_count("misses")
+
     payload = {
         "model": model,
         "instructions": CODEX_SYSTEM_PROMPT,
@@ -142,32 +468,45 @@ def call_codex(prompt: str, *, model: str, expect_json: bool = False) -> Optiona
     }
     if OPENAI_REASONING_EFFORT:
         payload["reasoning"] = {"effort": OPENAI_REASONING_EFFORT}
+    if OPENAI_STREAM:
+        payload["stream"] = True
 
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
 
-    try:
-        response = requests.post(OPENAI_API_URL, headers=headers, json=payload, timeout=90)
-    except Exception as exc:
-        print(f"Codex request failed: {exc}")
+    response = _post_with_retry(headers, _json_dumps(payload))
+    if response is None:
         return None
 
-    if response.status_code >= 400:
-        preview = (response.text or "")[:800].replace("\n", " ")
-        print(f"Codex request failed: HTTP {response.status_code}: {preview}")
-        return None
+    with response:
+        if response.status_code >= 400:
+            preview = (response.text or "")[:800].replace("\n", " ")
+            print(f"Codex request failed: HTTP {response.status_code}: {preview}")
+            return None
+
+        content_type = response.headers.get("Content-Type", "")
+        if OPENAI_STREAM and content_type.startswith("text/event-stream"):
+            try:
+                text, complete = _read_openai_stream(response)
+            except Exception as exc:
+                print(f"Codex stream read failed: {exc}")
+                return None
+            if text:
+                _cache_result(cache_path, text, complete, expect_json)
+                return text
+            print("Codex stream did not contain usable text.")
+            return None
 
-    try:
-        response_json = response.json()
-    except Exception as exc:
-        preview = (response.text or "")[:500].replace("\n", " ")
-        print(f"Codex response decode failed: {exc}; body={preview}")
-        return None
+        try:
+            response_json = _json_loads(response.content)
+        except Exception as exc:
+            preview = (response.text or "")[:500].replace("\n", " ")
+            print(f"Codex response decode failed: {exc}; body={preview}")
+            return None
 
     text = _extract_openai_text(response_json)
     if text:
+        complete = isinstance(response_json, dict) and _is_complete_body(response_json)
+        _cache_result(cache_path, text, complete, expect_json)
         return text
 
     print(f"Codex response did not contain usable text: {str(response_json)[:500]}")
@@ -186,13 +525,21 @@ def post_comment(text: str) -> None:
     }
 
     try:
-        response = requests.post(url, headers=headers, json={"body": text}, timeout=30)
+        response = _SESSION.post(url, headers=headers, data=_json_dumps({"body": text}), timeout=GITHUB_TIMEOUT)
         if response.status_code >= 400:
             print(f"GitHub comment failed: HTTP {response.status_code} {response.text[:300]}")
     except Exception as exc:
         print(f"Failed to post GitHub comment: {exc}")
 
 
+def _read_existing(path: str) -> Optional[str]:
+    try:
+        with open(path, "r", encoding="utf-8") as handle:
+            return handle.read()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
 def apply_code(files_dict: Optional[Dict[str, str]]) -> Tuple[bool, str]:
     """
     Safely write Codex-generated code to the local workspace.
@@ -217,7 +564,9 @@ def apply_code(files_dict: Optional[Dict[str, str]]) -> Tuple[bool, str]:
 
     applied_count = 0
     skipped_paths = []
+    unchanged_paths = []
     failed_paths = []
+    created_dirs = set()
 
     for path, content in files_dict.items():
         if not isinstance(path, str) or not isinstance(content, str):
@@ -235,10 +584,21 @@ def apply_code(files_dict: Optional[Dict[str, str]]) -> Tuple[bool, str]:
             print(f"Security filter blocked path traversal: {path}")
             continue
 
+        if os.path.normpath(path) in _EXCERPTED_PATHS:
+            skipped_paths.append(path)
+            print(f"Refused to overwrite excerpted file with a partial answer: {path}")
+            continue
+
+        if _read_existing(path) == content:
+            unchanged_paths.append(path)
+            print(f"Unchanged, not rewritten: {path}")
+            continue
+
         try:
             directory = os.path.dirname(path)
-            if directory:
+            if directory and directory not in created_dirs:
                 os.makedirs(directory, exist_ok=True)
+                created_dirs.add(directory)
             with open(path, "w", encoding="utf-8") as handle:
                 handle.write(content)
             print(f"Wrote file: {path}")
@@ -251,11 +611,16 @@ def apply_code(files_dict: Optional[Dict[str, str]]) -> Tuple[bool, str]:
         extras = []
         if skipped_paths:
             extras.append(f"skipped={', '.join(skipped_paths)}")
+        if unchanged_paths:
+            extras.append(f"unchanged={', '.join(unchanged_paths)}")
         if failed_paths:
             extras.append(f"failed={', '.join(failed_paths)}")
         suffix = f" ({'; '.join(extras)})" if extras else ""
         return True, f"Applied {applied_count} file(s){suffix}."
 
+    if unchanged_paths and not failed_paths:
+        return False, f"Codex returned files identical to the current tree: {', '.join(unchanged_paths)}"
+
     if skipped_paths:
         return False, f"All candidate files were blocked by safety policy: {', '.join(skipped_paths)}"
 
@@ -280,6 +645,7 @@ Task:
 - Return ONLY a valid JSON object.
 - Keys must be REAL relative file paths.
 - Values must be COMPLETE replacement file contents.
+- Files marked EXCERPT are partial and read-only; never include them as keys.
 
 Example:
 {{
@@ -345,6 +711,7 @@ Return ONLY valid JSON with this shape:
 Rules:
 - Keys in "files" must be real relative file paths.
 - Values in "files" must be complete replacement contents.
+- Files marked EXCERPT in the context are partial and read-only; never include them in "files".
 - If no safe auto-apply is possible, set winner to "NONE" and files to {{}}.
 - Do not include markdown code fences or any text outside the JSON object."""
 
@@ -382,8 +749,12 @@ def run_manual_apply(choice: str, context: str) -> None:
 def run_auto_flow(context: str) -> None:
     print("Starting Codex comparison flow...")
 
-    plan_a = call_codex(build_plan_prompt(context, "A"), model=OPENAI_MODEL) or "Codex plan A generation failed."
-    plan_b = call_codex(build_plan_prompt(context, "B"), model=OPENAI_MODEL) or "Codex plan B generation failed."
+    # The two plans are independent network-bound calls; request them concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_a = executor.submit(call_codex, build_plan_prompt(context, "A"), model=OPENAI_MODEL)
+        future_b = executor.submit(call_codex, build_plan_prompt(context, "B"), model=OPENAI_MODEL)
+        plan_a = future_a.result() or "Codex plan A generation failed."
+        plan_b = future_b.result() or "Codex plan B generation failed."
 
     raw_verdict = call_codex(build_arbiter_prompt(plan_a, plan_b), model=OPENAI_REVIEW_MODEL, expect_json=True)
     preview = raw_verdict[:500] if raw_verdict else "None"
@@ -433,20 +804,37 @@ Reply with one of the following commands to force a plan:
     post_comment(fallback_message)
 
 
+def parse_apply_command(comment: str) -> Optional[str]:
+    """Return the plan named by an `/apply X` comment, or None."""
+    # The workflow only forwards comments that start with /apply, so a plain
+    # prefix split covers the normal case; the regex handles anything else.
+    rest = comment[len(_APPLY_COMMAND):]
+    if comment.startswith(_APPLY_COMMAND) and rest[:1].isspace():
+        parts = rest.split(None, 1)
+        if parts and parts[0].upper() in _APPLY_CHOICES:
+            return parts[0].upper()
+
+    match = _APPLY_COMMAND_RE.search(comment)
+    return match.group(1).upper() if match else None
+
+
 def main() -> None:
-    command = re.search(r"/apply\s+(A|B|HYBRID)", COMMENT_BODY, re.IGNORECASE)
+    choice = parse_apply_command(COMMENT_BODY)
+    _prune_cache()
     context = get_context()
 
-    if command:
-        choice = command.group(1).upper()
-        if choice == "HYBRID":
-            post_comment("`/apply HYBRID` is not supported in Codex mode. Use `/apply A` or `/apply B`.")
+    try:
+        if choice:
+            if choice == "HYBRID":
+                post_comment("`/apply HYBRID` is not supported in Codex mode. Use `/apply A` or `/apply B`.")
+                return
+            print(f"Received manual apply command: /apply {choice}")
+            run_manual_apply(choice, context)
             return
-        print(f"Received manual apply command: /apply {choice}")
-        run_manual_apply(choice, context)
-        return
 
-    run_auto_flow(context)
+        run_auto_flow(context)
+    finally:
+        print(f"Codex cache: {_CACHE_STATS['hits']} hit(s), {_CACHE_STATS['misses']} miss(es)")
 
 
 if __name__ == "__main__":
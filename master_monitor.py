@@ -1,41 +1,67 @@
 #!/usr/bin/env python3
 # /home/master_monitor.py
+import json
 import os
+import re
+import signal
 import sys
 import subprocess
+import threading
 import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from types import MappingProxyType
+try:
+    # Linux 上显式使用 inotify 实现，避免自动选择时回退到轮询
+    from watchdog.observers.inotify import InotifyObserver as Observer
+except ImportError:
+    from watchdog.observers import Observer
+from watchdog.events import PatternMatchingEventHandler
 
 # ✅ 导入统一脱敏模块（带降级方案）
 try:
     from sanitizer import LogSanitizer
 except ImportError:
     print("⚠️  未找到 sanitizer.py，使用内置脱敏模块")
-    import re
     class LogSanitizer:
-        """轻量级内置脱敏器"""
-        @staticmethod
-        def sanitize(text):
-            if not text:
-                return ""
+        """轻量级内置脱敏器 (正则在定义时编译一次)"""
+        _RULES = (
             # 邮箱
-            text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '***@***.com', text)
+            (re.compile(r'\b[A-Za-z0-9._%+-]+@(?:[A-Za-z0-9-]+\.)+[A-Za-z]{2,}\b'), '***@***.com'),
             # IP地址
-            text = re.sub(r'\b(?:\d{1,3}\.){3}\d{1,3}\b', '*.*.*.*', text)
+            (re.compile(r'\b(?:\d{1,3}\.){3}\d{1,3}\b'), '*.*.*.*'),
             # Token/Key
-            text = re.sub(r'(?:sk-|pk-|ghp_|gho_)[A-Za-z0-9_+\-=]{20,}', '***KEY***', text)
+            (re.compile(r'(?:sk-|pk-|ghp_|gho_)[A-Za-z0-9_+\-=]{20,}'), '***KEY***'),
             # JWT
-            text = re.sub(r'eyJ[A-Za-z0-9_-]+\.eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+', 'eyJ***JWT***', text)
+            (re.compile(r'eyJ[A-Za-z0-9_-]+\.eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+'), 'eyJ***JWT***'),
+        )
+
+        @classmethod
+        def sanitize(cls, text):
+            if not text:
+                return ""
+            for pattern, repl in cls._RULES:
+                text = pattern.sub(repl, text)
             return text
 
+# ✅ 进程内加载上报模块，避免每次触发都启动新的 Python 解释器
+try:
+    import universal_fix
+except ImportError as e:
+    print(f"⚠️  无法导入 universal_fix ({e})，回退到子进程调用")
+    universal_fix = None
+
+# 上报任务线程池：复用工作线程，崩溃风暴时也最多两个上报并发执行
+REPORT_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="report")
+
 # ==================== 配置区 ====================
-SERVICE_MAP = {
+# 只读映射，运行期间不可被意外修改
+SERVICE_MAP = MappingProxyType({
     "pocketbase": "/home/pb/error.log",
     "ai-proxy":   "/home/ai-proxy/error.log",
     "websocket":  "/home/websocket-server/error.log"
-}
+})
 
 # ⚡ 冷却期缩短为 2 分钟 (平衡响应速度与防刷屏)
 COOLDOWN_SECONDS = 120  
@@ -43,12 +69,66 @@ COOLDOWN_SECONDS = 120
 # 🚨 严重故障阈值: 5分钟内崩溃超过5次
 CRASH_WINDOW = 300
 CRASH_LIMIT = 5
+
+# 合并突发写入事件的窗口 (秒)，一次多行报错只处理一次
+DEBOUNCE_SECONDS = 0.05
+
+# 每次读取的块大小，以及块间保留的重叠字节数 (需大于最长关键字)
+READ_CHUNK_SIZE = 64 * 1024
+CHUNK_OVERLAP = 16
+
+# inotify 每用户 watch 数下限，低于此值时启动告警 (超限后事件会被静默丢弃)
+INOTIFY_MIN_WATCHES = 8192
+INOTIFY_WATCHES_PATH = "/proc/sys/fs/inotify/max_user_watches"
+
+# 读取位置持久化文件 (不放在 /home 下，避免被部署同步删除) 及最短落盘间隔 (秒)
+POSITIONS_STATE_PATH = "/var/lib/master_monitor/positions.json"
+POSITIONS_SAVE_INTERVAL = 5
 # ================================================
 
+# 错误关键字 (大小写不敏感)，启动时编译为单个正则，每次事件只扫描一遍
+# 关键字均为 ASCII，直接在原始字节上匹配，无需解码日志
+ERROR_KEYWORDS = ("error", "exception", "traceback", "panic", "fatal")
+
+def _keyword_pattern(keywords):
+    """按首字母分组生成交替正则，如 e(?:rror|xception)|panic，减少每个位置的分支尝试"""
+    groups = {}
+    for kw in keywords:
+        groups.setdefault(kw[0].lower(), []).append(re.escape(kw[1:].lower()))
+    parts = []
+    for first, tails in groups.items():
+        tail = tails[0] if len(tails) == 1 else f"(?:{'|'.join(tails)})"
+        parts.append(re.escape(first) + tail)
+    return "|".join(parts)
+
+_ERROR_RE = re.compile(_keyword_pattern(ERROR_KEYWORDS).encode("ascii"), re.IGNORECASE)
+
+# 已知无害的日志消息 (正常退出等)，即使含错误关键字也不触发上报
+# 必须整行匹配 (允许前面的时间戳/级别前缀)，消息里多出任何内容都按真实错误处理
+# 注意：端口占用 (address already in use) 也是真实崩溃循环的报错，不能列入
+BENIGN_PATTERNS = (
+    r"SIGTERM received(?:, (?:exiting|shutting down)(?: gracefully)?)?\.?",
+    r"graceful(?:ly)? shutdown(?: complete[d]?| finished)?\.?",
+    r"shutting down gracefully\.?",
+)
+_BENIGN_LINE_PREFIX = r"[\d/:.,TZ+ -]*(?:\[?(?:INFO|WARN|WARNING|ERROR)\]?:?\s*)?"
+_BENIGN_RE = re.compile(
+    rf"{_BENIGN_LINE_PREFIX}(?:{'|'.join(BENIGN_PATTERNS)})\s*".encode("ascii"), re.IGNORECASE
+)
+# 含这些关键字的行一律视为真实错误，无害模式不能将其屏蔽
+_SEVERE_RE = re.compile(rb"panic|fatal|traceback", re.IGNORECASE)
+
 # 状态追踪
 file_positions = {}
+# watchdog 在工作线程中分发事件，读写 file_positions 统一加锁
+positions_lock = threading.Lock()
+file_inodes = {}
+last_positions_save = 0
+# 节流时挂起的补写定时器，保证最后一次更新最迟 POSITIONS_SAVE_INTERVAL 秒后落盘
+positions_flush_timer = None
 last_fix_time = {}
-crash_history = {} # 记录崩溃时间戳列表: {'pocketbase': [t1, t2...]}
+# 记录崩溃时间戳队列: {'pocketbase': deque([t1, t2...])}，有界且按时间有序
+crash_history = defaultdict(lambda: deque(maxlen=CRASH_LIMIT * 4))
 
 def log(msg, level="INFO"):
     """带时间戳的日志"""
@@ -56,26 +136,41 @@ def log(msg, level="INFO"):
     print(f"[{datetime.now().strftime('%H:%M:%S')}] {icon} {msg}", flush=True)
 
 def contains_real_error(new_content, service_name):
-    # 忽略 PB 正常启动日志
-    if service_name == "pocketbase" and "PocketBase v" in new_content and "started" in new_content:
-        return False
-        
-    error_keywords = ["error", "Error", "ERROR", "panic", "PANIC", "fatal", "FATAL", "exception", "Traceback"]
-    return any(kw in new_content for kw in error_keywords)
+    # 忽略 PB 正常启动日志：启动横幅只出现在新内容的第一行，只跳过这一行，
+    # 同一次读取中紧随其后的崩溃日志仍要扫描
+    pos = 0
+    if service_name == "pocketbase" and new_content.startswith(b"PocketBase v"):
+        newline = new_content.find(b"\n")
+        first_line_end = len(new_content) if newline == -1 else newline
+        if new_content.find(b"started", 0, first_line_end) != -1:
+            pos = first_line_end
+
+    # 逐个命中检查所在行，只有命中行全部是已知无害消息 (整行匹配) 时才忽略
+    while True:
+        m = _ERROR_RE.search(new_content, pos)
+        if m is None:
+            return False
+        start = new_content.rfind(b"\n", 0, m.start()) + 1
+        end = new_content.find(b"\n", m.end())
+        if end == -1:
+            end = len(new_content)
+        if _SEVERE_RE.search(new_content, start, end) or not _BENIGN_RE.fullmatch(new_content, start, end):
+            return True
+        pos = end
 
 def check_critical_state(service_name):
     """检测是否发生严重连续崩溃"""
     now = time.time()
-    if service_name not in crash_history:
-        crash_history[service_name] = []
+    history = crash_history[service_name]
     
-    # 清理过期记录 (保留最近 CRASH_WINDOW 秒内的)
-    crash_history[service_name] = [t for t in crash_history[service_name] if now - t < CRASH_WINDOW]
+    # 从队头清理过期记录 (保留最近 CRASH_WINDOW 秒内的)
+    while history and now - history[0] >= CRASH_WINDOW:
+        history.popleft()
     
     # 添加本次记录
-    crash_history[service_name].append(now)
+    history.append(now)
     
-    count = len(crash_history[service_name])
+    count = len(history)
     if count >= CRASH_LIMIT:
         log(f"[{service_name}] 严重故障! {CRASH_WINDOW/60}分钟内崩溃 {count} 次! 请人工介入!", "CRITICAL")
         # TODO: 这里可以接入邮件或短信通知接口
@@ -100,53 +195,228 @@ def trigger_fix_process(service_name):
     log(f"[{service_name}] 触发自动上报流程...", "INFO")
     
     try:
-        # 调用 universal_fix.py
-        subprocess.run(["python3", "/home/universal_fix.py", service_name], check=False)
-        last_fix_time[service_name] = now
-        log(f"[{service_name}] 上报完成，进入冷却", "INFO")
+        if universal_fix is not None:
+            # 线程池中上报，网络请求不阻塞日志事件处理
+            future = REPORT_EXECUTOR.submit(universal_fix.collect_and_report, service_name)
+            future.add_done_callback(lambda f: report_done(service_name, f))
+            last_fix_time[service_name] = now
+            log(f"[{service_name}] 已提交上报，进入冷却", "INFO")
+        else:
+            # 调用 universal_fix.py
+            subprocess.run(["python3", "/home/universal_fix.py", service_name], check=False)
+            last_fix_time[service_name] = now
+            log(f"[{service_name}] 上报完成，进入冷却", "INFO")
     except Exception as e:
         log(f"调用修复脚本失败: {e}", "ERROR")
 
-class LogHandler(FileSystemEventHandler):
+def report_done(service_name, future):
+    """上报任务结束回调，记录异常而不是让其静默丢失"""
+    e = future.exception()
+    if e is not None:
+        log(f"[{service_name}] 上报流程异常: {e}", "ERROR")
+
+def get_position(path):
+    with positions_lock:
+        return file_positions.get(path, 0)
+
+def set_position(path, pos, inode=None):
+    with positions_lock:
+        file_positions[path] = pos
+        if inode is not None:
+            file_inodes[path] = inode
+
+def load_positions():
+    """读取上次保存的 {路径: [inode, 位置]}，文件不存在或损坏时返回空字典"""
+    try:
+        with open(POSITIONS_STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_positions(force=False):
+    """原子写入当前读取位置，非强制时按 POSITIONS_SAVE_INTERVAL 节流"""
+    global last_positions_save, positions_flush_timer
+    with positions_lock:
+        now = time.time()
+        if not force and now - last_positions_save < POSITIONS_SAVE_INTERVAL:
+            # 本次被节流：挂一个尾沿定时器，间隔到期后补写最新位置
+            if positions_flush_timer is None:
+                delay = POSITIONS_SAVE_INTERVAL - (now - last_positions_save)
+                positions_flush_timer = threading.Timer(delay, flush_positions)
+                positions_flush_timer.daemon = True
+                positions_flush_timer.start()
+            return
+        last_positions_save = now
+        state = {path: [file_inodes.get(path), pos] for path, pos in file_positions.items()}
+    try:
+        os.makedirs(os.path.dirname(POSITIONS_STATE_PATH), exist_ok=True)
+        tmp_path = POSITIONS_STATE_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, POSITIONS_STATE_PATH)
+    except OSError as e:
+        log(f"保存读取位置失败: {e}", "WARN")
+
+def flush_positions():
+    """尾沿定时器回调：清除挂起标记后强制落盘"""
+    global positions_flush_timer
+    with positions_lock:
+        positions_flush_timer = None
+    save_positions(force=True)
+
+def handle_sigterm(signum, frame):
+    """supervisor 以 SIGTERM 停止进程：先保存读取位置，再走正常退出流程"""
+    save_positions(force=True)
+    raise SystemExit(0)
+
+class LogTailer:
+    """单个服务日志的增量读取状态 (文件句柄、防抖定时器)"""
     def __init__(self, service_name, log_path):
         self.service_name = service_name
         self.log_path = log_path
+        # 长期持有日志文件句柄，避免每个事件都 open/close
+        self._fh = None
+        self._inode = None
+        self._open_log()
+        self._timer = None
+        self._timer_lock = threading.Lock()
+        self._read_lock = threading.Lock()
 
-    def on_modified(self, event):
-        if event.src_path != self.log_path: return
-        
+    def _open_log(self):
+        """(重新)打开日志并定位到已记录的位置，文件不存在时返回 False"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        try:
+            # 二进制模式：关键字检测不需要解码，只有预览才解码
+            fh = open(self.log_path, "rb", buffering=READ_CHUNK_SIZE)
+        except FileNotFoundError:
+            return False
+        self._fh = fh
+        self._inode = os.fstat(fh.fileno()).st_ino
+        fh.seek(get_position(self.log_path))
+        return True
+
+    def _has_new_data(self):
+        """只 stat 不读：大小与已读位置相同且未轮转，说明只是属性变化等无新内容的事件"""
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            return False
+        return st.st_ino != self._inode or st.st_size != get_position(self.log_path)
+
+    def schedule_read(self):
+        if not self._has_new_data(): return
+
+        # 防抖：窗口内的后续事件并入已排队的那次读取
+        with self._timer_lock:
+            if self._timer is not None: return
+            self._timer = threading.Timer(DEBOUNCE_SECONDS, self._process_new_content)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _process_new_content(self):
+        with self._timer_lock:
+            self._timer = None
+        with self._read_lock:
+            self._read_new_content()
+
+    def _read_new_content(self):
         try:
-            current_pos = file_positions.get(self.log_path, 0)
-            if not os.path.exists(self.log_path): return
-
-            with open(self.log_path, "r", encoding="utf-8", errors="ignore") as f:
-                f.seek(current_pos)
-                new_content = f.read()
-                
-                # ✅ 修复：始终更新文件指针，避免重复读取旧日志
-                file_positions[self.log_path] = f.tell()
-                
-                if not new_content: return
-                
-                # ✅ 修复：预览日志前进行脱敏
-                preview = new_content[:80].replace("\n", " ")
-                safe_preview = LogSanitizer.sanitize(preview)
-                log(f"[{self.service_name}] 新日志: {safe_preview}...", "INFO")
-
-                if contains_real_error(new_content, self.service_name):
-                    trigger_fix_process(self.service_name)
+            try:
+                st = os.stat(self.log_path)
+            except FileNotFoundError:
+                return
+
+            # 日志轮转 (inode 变化) 时重新打开，截断时回到文件头
+            if self._fh is None or st.st_ino != self._inode:
+                set_position(self.log_path, 0)
+                if not self._open_log(): return
+            elif st.st_size < get_position(self.log_path):
+                self._fh.seek(0)
+                set_position(self.log_path, 0)
+
+            if st.st_size == get_position(self.log_path): return
+
+            # 分块读取新增内容，命中错误即停止，避免一次性读入整段日志
+            # 只读到本次 stat 时的大小，读取期间继续追加的内容留给下一次事件
+            remaining = st.st_size - self._fh.tell()
+            found_error = False
+            carry = b""
+            chunk = self._fh.read(min(remaining, READ_CHUNK_SIZE))
+            if not chunk: return
+
+            # ✅ 修复：预览日志前进行脱敏
+            preview = chunk[:80].decode("utf-8", errors="ignore").replace("\n", " ")
+            safe_preview = LogSanitizer.sanitize(preview)
+            log(f"[{self.service_name}] 新日志: {safe_preview}...", "INFO")
+
+            while chunk:
+                remaining -= len(chunk)
+                # 带上前一块的末尾，防止关键字被块边界截断
+                if contains_real_error(carry + chunk, self.service_name):
+                    found_error = True
+                    break
+                if remaining <= 0: break
+                carry = chunk[-CHUNK_OVERLAP:]
+                chunk = self._fh.read(min(remaining, READ_CHUNK_SIZE))
+
+            if found_error:
+                # 命中后只是不再扫描：本轮突发的剩余内容直接跳过，
+                # 否则下一次写入会重读旧报错并再次上报
+                self._fh.seek(st.st_size)
+
+            # ✅ 修复：始终更新文件指针，避免重复读取旧日志
+            set_position(self.log_path, self._fh.tell(), self._inode)
+            save_positions()
+
+            if found_error:
+                trigger_fix_process(self.service_name)
 
         except Exception as e:
             log(f"读取日志出错: {e}", "ERROR")
 
+class LogDispatcher(PatternMatchingEventHandler):
+    """所有服务共用一个处理器：watchdog 先按路径过滤，再按路径分发给对应的 LogTailer"""
+    def __init__(self, tailers):
+        super().__init__(patterns=list(tailers), ignore_directories=True, case_sensitive=True)
+        self.tailers = tailers
+
+    def on_modified(self, event):
+        tailer = self.tailers.get(event.src_path)
+        if tailer is not None:
+            tailer.schedule_read()
+
+def check_inotify_limit():
+    """检查 inotify watch 上限，过低时提示调整 sysctl"""
+    try:
+        with open(INOTIFY_WATCHES_PATH) as f:
+            limit = int(f.read().strip())
+    except (OSError, ValueError):
+        return
+    if limit < INOTIFY_MIN_WATCHES:
+        log(f"inotify max_user_watches 仅为 {limit}，建议: sysctl -w fs.inotify.max_user_watches={INOTIFY_MIN_WATCHES}", "WARN")
+
 def init_file_positions():
+    """inode 未变且文件未截断时从上次位置续读；轮转/截断过则从头读；无保存状态时从文件末尾开始"""
+    saved = load_positions()
     for service, path in SERVICE_MAP.items():
-        if os.path.exists(path):
-            with open(path, "rb") as f:
-                f.seek(0, 2)
-                file_positions[path] = f.tell()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            set_position(path, 0)
+            continue
+        inode, pos = saved.get(path, (None, None))
+        if inode == st.st_ino and pos is not None and pos <= st.st_size:
+            set_position(path, pos, inode)
+            log(f"[{service}] 从上次位置续读 (offset {pos})", "INFO")
+        elif inode is not None:
+            # 停机期间日志被轮转或截断：新文件里的内容都是停机后写入的，从头读
+            set_position(path, 0, st.st_ino)
+            log(f"[{service}] 日志已轮转或截断，从文件头续读", "INFO")
         else:
-            file_positions[path] = 0
+            # 没有保存过状态：首次启动，只监控之后的新日志
+            set_position(path, st.st_size, st.st_ino)
 
 if __name__ == "__main__":
     log("===================================")
@@ -154,17 +424,33 @@ if __name__ == "__main__":
     log("===================================")
     
     init_file_positions()
+    check_inotify_limit()
+    signal.signal(signal.SIGTERM, handle_sigterm)
     observer = Observer()
-    
+
+    tailers = {}
+    directories = set()
     for service, path in SERVICE_MAP.items():
         directory = os.path.dirname(path)
         if os.path.exists(directory):
-            observer.schedule(LogHandler(service, path), path=directory, recursive=False)
+            tailers[path] = LogTailer(service, path)
+            directories.add(directory)
             log(f"正在监控: {service}", "INFO")
+
+    # 每个目录只注册一次监听，多个日志同目录时共用同一个 inotify watch
+    dispatcher = LogDispatcher(tailers)
+    for directory in directories:
+        observer.schedule(dispatcher, path=directory, recursive=False)
             
     observer.start()
+    # 补扫监控停机期间写入的日志
+    for tailer in tailers.values():
+        tailer.schedule_read()
     try:
-        while True: time.sleep(1)
-    except KeyboardInterrupt:
+        # 阻塞等待观察者线程，主线程不再每秒轮询唤醒
+        observer.join()
+    except (KeyboardInterrupt, SystemExit):
         observer.stop()
-    observer.join()
+        observer.join()
+        save_positions(force=True)
+        REPORT_EXECUTOR.shutdown(wait=False)
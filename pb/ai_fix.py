@@ -32,15 +32,29 @@ class AliyunClient:
 });"""
         return json.dumps({"message": "Simulated AI response for: " + prompt[:50] + "..."})
 
+# Only the tail of the log is relevant; never load the whole file
+TAIL_BYTES = 8192
+TAIL_LINES = 20
+
 def read_error_context(log_file_path):
     # Placeholder for reading error context from a log file
     # As per PLAN B, pb/ai_fix.py reads from the log file itself.
     try:
-        with open(log_file_path, 'r') as f:
-            # Read last few lines or parse for specific error patterns
-            lines = f.readlines()
+        with open(log_file_path, 'rb') as f:
+            # Seek to the last TAIL_BYTES and keep the last few lines; long
+            # lines may leave too few in that window, so double it until
+            # enough complete lines are found or the whole file is read
+            size = os.fstat(f.fileno()).st_size
+            chunk = TAIL_BYTES
+            while True:
+                f.seek(max(0, size - chunk))
+                lines = f.read().decode('utf-8', errors='ignore').splitlines()
+                if len(lines) > TAIL_LINES or chunk >= size:
+                    break
+                chunk *= 2
+            lines = lines[-TAIL_LINES:]
             if lines:
-                return {"last_error_line": lines[-1].strip(), "full_log": "".join(lines)}
+                return {"last_error_line": lines[-1].strip(), "full_log": "\n".join(lines)}
     except FileNotFoundError:
         logging.warning(f"Log file not found: {log_file_path}")
     return {"last_error_line": "No error found", "full_log": ""}
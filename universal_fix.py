@@ -3,162 +3,328 @@
 服务器端错误上报脚本（安全增强版）
 职责：收集错误日志和相关代码，脱敏后通过 GitHub API 创建 Issue
 """
+import fcntl
+import hashlib
+import json
+import logging
 import os
+import re
 import sys
-import glob
+import time
 import requests
-import re
+from collections import namedtuple
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# 可选：orjson 序列化更快，且直接输出 UTF-8，不把中文/emoji 转义成 \uXXXX
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 只输出消息本身；StreamHandler 每条记录写完即 flush，supervisor 日志依然实时
+logger = logging.getLogger("universal_fix")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# 统一使用 sanitizer.py 的脱敏规则；缺失时直接失败，绝不上报未脱敏的日志
+try:
+    from sanitizer import LogSanitizer
+except ImportError:
+    logger.error("❌ 未找到 sanitizer.py，拒绝上报未脱敏内容")
+    raise
 
 # ==================== 配置区 ====================
 GITHUB_TOKEN = os.getenv("PERSONAL_ACCESS_TOKEN")
 REPO = "emonet1/index"
 
+# 每个服务的 (代码目录, 错误日志, 代码后缀)，不可变且可按字段名访问
+Project = namedtuple("Project", "code_dir log_path suffix")
+
 PROJECTS = {
-    "pocketbase": ["/home/pb/pb_hooks", "/home/pb/error.log", ".js"],
-    "ai-proxy":   ["/home/ai-proxy", "/home/ai-proxy/error.log", ".py"],
-    "websocket":  ["/home/websocket-server", "/home/websocket-server/error.log", ".js"]
+    "pocketbase": Project("/home/pb/pb_hooks", "/home/pb/error.log", ".js"),
+    "ai-proxy":   Project("/home/ai-proxy", "/home/ai-proxy/error.log", ".py"),
+    "websocket":  Project("/home/websocket-server", "/home/websocket-server/error.log", ".js")
 }
+
+# 每个代码文件在 Issue 中最多展示的字符数，以及读取上限 (留出脱敏改变长度的余量)
+CODE_SNIPPET_LIMIT = 2000
+CODE_READ_LIMIT = 8192
+
+# 上报状态目录 (指纹等)，放在 /home 之外，避免被部署同步删除
+STATE_DIR = os.getenv("UNIVERSAL_FIX_STATE_DIR", "/var/lib/universal_fix")
+# 同一服务两次成功上报的最小间隔 (秒)，防止坏修复 -> 重启 -> 再上报的死循环
+REPORT_MIN_INTERVAL = 60
+# 连续上报失败 N 次后暂停 2**N 秒，上限如下
+FAIL_BACKOFF_MAX = 3600
 # ================================================
 
-class LogSanitizer:
-    """内置日志脱敏器，确保不依赖外部文件"""
-    
-    @staticmethod
-    def sanitize(text):
-        if not text:
-            return ""
-        
-        # 1. 邮箱
-        text = re.sub(
-            r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b',
-            '***@***.com',
-            text
-        )
-        
-        # 2. IP地址
-        text = re.sub(
-            r'\b(?:\d{1,3}\.){3}\d{1,3}\b',
-            '*.*.*.*',
-            text
-        )
-        
-        # 3. 各种Token (sk-, pk-, ghp_)
-        text = re.sub(
-            r'(?:sk-|pk-|ghp_|gho_|ssh-rsa)[A-Za-z0-9_+\-=]{20,}',
-            '***SECRET_REDACTED***',
-            text
-        )
-        
-        # 4. 密码字段
-        text = re.sub(
-            r'(?i)(password|passwd|pwd|secret)["\']?\s*[:=]\s*["\']?([^"\'\s]+)',
-            r'\1=***',
-            text
-        )
-        
-        # 5. JWT Token
-        text = re.sub(
-            r'eyJ[A-Za-z0-9_-]+\.eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+',
-            'eyJ***REDACTED***',
-            text
-        )
-        
-        # 6. 手机号
-        text = re.sub(
-            r'\b1[3-9]\d{9}\b',
-            lambda m: m.group(0)[:3] + "****" + m.group(0)[-4:],
-            text
-        )
-        
-        # 7. 身份证号
-        text = re.sub(
-            r'\b\d{17}[\dXx]\b',
-            lambda m: m.group(0)[:6] + "********" + m.group(0)[-4:],
-            text
-        )
-        
-        return text
-    
-    @staticmethod
-    def validate(text):
-        """验证是否还有敏感信息"""
-        sensitive_patterns = [
-            (r'sk-[a-zA-Z0-9]{20,}', 'API密钥'),
-            (r'ghp_[a-zA-Z0-9]{36}', 'GitHub Token'),
-            (r'\b\d{17}[\dXx]\b', '身份证号'),
-        ]
-        
-        found_issues = []
-        for pattern, name in sensitive_patterns:
-            if re.search(pattern, text):
-                found_issues.append(name)
-        
-        return found_issues
+
+def build_github_session():
+    """复用连接的 GitHub API 会话：鉴权头只设置一次，连接失败自动重试"""
+    session = requests.Session()
+    # 创建 Issue 不是幂等操作 (GitHub 可能已创建成功却返回 502)，
+    # 只重试请求未发出的连接错误，读超时和 5xx 不重试，避免重复 Issue
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3)
+    session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry))
+    session.headers.update({
+        "Accept": "application/vnd.github.v3+json",
+        "Content-Type": "application/json",
+    })
+    if GITHUB_TOKEN:
+        session.headers["Authorization"] = f"token {GITHUB_TOKEN}"
+    return session
+
+
+GITHUB_SESSION = build_github_session()
+
+
+def json_dumps(data):
+    """序列化为 UTF-8 字节，优先使用 orjson"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+# 计算指纹前抹掉每次都会变化的时间戳/PID/内存地址，同一错误反复出现时指纹不变
+# 与 .github/scripts/ai_fix.py 的 _VOLATILE_RE 保持一致
+_VOLATILE_RE = re.compile(
+    r'\d{4}[-/]\d{2}[-/]\d{2}[T ]\d{2}:\d{2}(?::\d{2}(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?'
+    r'|\b\d{2}/\d{2} \d{2}:\d{2}\b'
+    r'|\b\d{2}:\d{2}:\d{2}(?:[.,]\d+)?\b'
+    r'|\b(?:pid|PID)[=: ]\s*\d+'
+    r'|\b0x[0-9a-fA-F]{6,}\b'
+)
+
+
+def report_fingerprint(service, log_text, code_entries):
+    """日志尾部 (去掉易变字段) + 相关代码文件的大小/修改时间 -> 指纹"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(service.encode())
+    h.update(_VOLATILE_RE.sub("#", log_text).encode("utf-8", errors="ignore"))
+    for entry in code_entries:
+        st = entry.stat()
+        h.update(f"\0{entry.name}:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def _state_path(name):
+    return os.path.join(STATE_DIR, name)
+
+
+def read_state(name):
+    try:
+        with open(_state_path(name), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_state(name, value):
+    """原子写入状态文件，失败只告警，不影响上报流程"""
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        tmp_path = _state_path(name) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp_path, _state_path(name))
+    except OSError as e:
+        logger.warning(f"⚠️ 写入状态文件失败: {e}")
+
+
+def _state_age(name):
+    """状态文件距上次写入的秒数，不存在时返回 None"""
+    try:
+        return time.time() - os.path.getmtime(_state_path(name))
+    except OSError:
+        return None
+
+
+def report_throttled(service):
+    """检查冷却期和失败退避，需要跳过时返回原因"""
+    age = _state_age(f"stamp_{service}")
+    if age is not None and age < REPORT_MIN_INTERVAL:
+        return f"距上次上报仅 {int(age)} 秒"
+
+    try:
+        failures = int(read_state(f"failcount_{service}") or 0)
+    except ValueError:
+        failures = 0
+    if failures:
+        backoff = min(2 ** failures, FAIL_BACKOFF_MAX)
+        age = _state_age(f"failcount_{service}")
+        if age is not None and age < backoff:
+            return f"连续失败 {failures} 次，退避 {int(backoff - age)} 秒"
+    return None
+
+
+def record_report_result(service, ok):
+    """成功时刷新冷却时间戳并清零失败计数，失败时计数 +1"""
+    if ok:
+        write_state(f"stamp_{service}", str(int(time.time())))
+        try:
+            os.remove(_state_path(f"failcount_{service}"))
+        except OSError:
+            pass
+        return
+    try:
+        failures = int(read_state(f"failcount_{service}") or 0)
+    except ValueError:
+        failures = 0
+    write_state(f"failcount_{service}", str(failures + 1))
+
+
+def acquire_service_lock(service):
+    """非阻塞获取服务级文件锁，防止同一服务的多个进程并发上报
+
+    返回锁文件描述符；已被其他进程持有时返回 None；
+    状态目录不可用时返回 -1，降级为不加锁继续执行
+    """
+    try:
+        os.makedirs(STATE_DIR, exist_ok=True)
+        fd = os.open(_state_path(f"lock_{service}"), os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        logger.warning(f"⚠️ 无法创建锁文件，不加锁继续: {e}")
+        return -1
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def tail_lines(path, n=50, block=8192):
+    """从文件末尾按块向前读取，只取最后 n 行，不把整个日志读进内存"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = os.fstat(fd).st_size
+        buf = b""
+        # 需要 n+1 个换行才能保证第一行是完整的
+        while offset > 0 and buf.count(b"\n") <= n:
+            size = min(block, offset)
+            offset -= size
+            buf = os.pread(fd, size, offset) + buf
+    finally:
+        os.close(fd)
+    return buf.decode("utf-8", errors="ignore").splitlines(keepends=True)[-n:]
 
 
 def collect_and_report(service):
-    """收集信息并上报到 GitHub Issue"""
+    """收集信息并上报到 GitHub Issue (同一服务同时只允许一个进程执行)"""
     
     # ✅ 修复：提前检查环境变量，避免无效处理
     if not GITHUB_TOKEN:
-        print("❌ 缺少环境变量 PERSONAL_ACCESS_TOKEN，跳过上报", flush=True)
+        logger.error("❌ 缺少环境变量 PERSONAL_ACCESS_TOKEN，跳过上报")
         return
     
     if service not in PROJECTS:
-        print(f"❌ 未知服务: {service}", flush=True)
+        logger.error(f"❌ 未知服务: {service}")
+        return
+
+    lock_fd = acquire_service_lock(service)
+    if lock_fd is None:
+        logger.info(f"⏳ [{service}] 已有进程正在上报，跳过")
+        return
+    try:
+        _collect_and_report(service)
+    finally:
+        # 关闭描述符即释放 flock，进程异常退出时内核也会自动释放
+        if lock_fd >= 0:
+            os.close(lock_fd)
+
+
+def _collect_and_report(service):
+    """持锁后执行：冷却/指纹检查 -> 读取日志与代码 -> 创建 Issue"""
+    throttled = report_throttled(service)
+    if throttled:
+        logger.info(f"⏳ [{service}] {throttled}，跳过本次上报")
         return
 
     code_dir, log_path, suffix = PROJECTS[service]
-    print(f"📋 [{service}] 开始收集错误信息...", flush=True)
+    logger.info(f"📋 [{service}] 开始收集错误信息...")
 
     # ========== 第1步：读取日志 ==========
     if not os.path.exists(log_path):
-        print(f"❌ 日志不存在: {log_path}", flush=True)
+        logger.error(f"❌ 日志不存在: {log_path}")
         return
 
     try:
-        with open(log_path, "r", encoding="utf-8", errors="ignore") as f:
-            lines = f.readlines()[-50:]
-            raw_content = "".join(lines)
+        raw_content = "".join(tail_lines(log_path, 50))
     except Exception as e:
-        print(f"❌ 读取文件失败: {e}", flush=True)
+        logger.error(f"❌ 读取文件失败: {e}")
         return
 
     # ========== 第2步：脱敏处理 ==========
     safe_log = LogSanitizer.sanitize(raw_content)
     
     if len(safe_log) < 10:
-        print("💡 日志内容为空，跳过", flush=True)
+        logger.info("💡 日志内容为空，跳过")
         return
 
     # ========== 第3步：读取相关代码 ==========
-    files_section = ""
-    code_files = glob.glob(os.path.join(code_dir, f"*{suffix}"))
-    code_files.sort(key=os.path.getmtime, reverse=True)
+    file_parts = []
+    # scandir 一次列出目录，DirEntry.stat() 结果会被缓存
+    try:
+        with os.scandir(code_dir) as it:
+            entries = [e for e in it
+                       if e.name.endswith(suffix) and not e.name.startswith(".") and e.is_file()]
+    except OSError as e:
+        logger.warning(f"⚠️ 读取代码目录失败: {e}")
+        entries = []
+    entries.sort(key=lambda e: e.stat().st_mtime, reverse=True)
+    entries = entries[:2]
+
+    # 与上次成功上报的错误相同、代码也没有改动时，不再重复创建 Issue
+    fingerprint = report_fingerprint(service, raw_content, entries)
+    if read_state(f"fp_{service}") == fingerprint:
+        logger.info(f"💡 [{service}] 与上次上报的错误相同且代码未变，跳过")
+        return
     
-    for fpath in code_files[:2]:
+    for entry in entries:
+        fpath = entry.path
         try:
             with open(fpath, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
+                # 只读取文件开头，大文件不再整体载入内存
+                content = f.read(CODE_READ_LIMIT)
+                truncated = len(content) == CODE_READ_LIMIT
+                if truncated:
+                    # 丢弃可能被截断的最后一行，避免半截凭证躲过脱敏正则；
+                    # 压缩后的单行文件没有换行，退而在最后一个空白处截断，
+                    # 连空白都没有时保留开头 (之后仍会脱敏并截到 CODE_SNIPPET_LIMIT)
+                    cut = content.rfind("\n")
+                    if cut == -1:
+                        cut = max(content.rfind(" "), content.rfind("\t"))
+                    if cut != -1:
+                        content = content[:cut + 1]
                 safe_code = LogSanitizer.sanitize(content)
                 
-                if len(safe_code) > 2000:
-                    safe_code = safe_code[:2000] + "\n... (代码截断) ..."
+                if truncated or len(safe_code) > CODE_SNIPPET_LIMIT:
+                    safe_code = safe_code[:CODE_SNIPPET_LIMIT] + "\n... (代码截断) ..."
                 
                 fname = os.path.basename(fpath)
                 ext = suffix.replace(".", "")
-                files_section += f"\n#### `{fname}`\n```{ext}\n{safe_code}\n```\n"
+                file_parts.append(f"\n#### `{fname}`\n```{ext}\n{safe_code}\n```\n")
         except Exception as e:
-            print(f"⚠️ 读取代码文件失败: {e}", flush=True)
+            logger.warning(f"⚠️ 读取代码文件失败: {e}")
             pass
 
     # ========== 第4步：构建 Issue 内容 ==========
-    time_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    title_time = datetime.now().strftime('%m/%d %H:%M')
+    # 约定：日志和代码在读取时已各自脱敏，拼接后的 issue_body 不再整体 sanitize，
+    # 只在第5步用 validate() 做廉价的兜底检查
+    # 只取一次当前时间，保证正文与标题的时间一致
+    now = datetime.now()
+    time_str = now.strftime('%Y-%m-%d %H:%M:%S')
+    title_time = now.strftime('%m/%d %H:%M')
     title = f"[AUTO-FIX] {service} - {title_time} 服务异常"
     
-    # 使用多行字符串构建 issue_body（注意正确的语法）
+    # 全部用 f-string 片段拼接，编译期合并为一次字符串构建，不再逐段 + 复制
+    files_section = "".join(file_parts)
     issue_body = (
         "## 🚨 服务异常自动报告\n"
         f"**服务**: `{service}`\n"
@@ -166,10 +332,10 @@ def collect_and_report(service):
         "**脱敏状态**: ✅ 已通过 LogSanitizer 验证\n\n"
         "### 📋 错误日志（已脱敏）\n"
         "```\n"
-        + safe_log[:3000] +
+        f"{safe_log[:3000]}"
         "\n```\n\n"
         "### 📁 相关代码文件（已脱敏）\n"
-        + files_section +
+        f"{files_section}"
         "\n---\n"
         "*此 Issue 由服务器 `universal_fix.py` 自动创建*\n"
         "*修复将由 GitHub Actions AI 智能体自动完成并创建 PR*\n"
@@ -177,68 +343,68 @@ def collect_and_report(service):
     )
     
     # ========== 第5步：二次验证脱敏 ==========
-    validation_issues = LogSanitizer.validate(issue_body)
-    if validation_issues:
-        print("❌ 检测到可能的敏感信息泄漏，终止上报！", flush=True)
-        for issue in validation_issues:
-            print(f"  - {issue}", flush=True)
+    # 常见情况下没有命中，只做一次短路检查；命中时才收集明细用于打印
+    if LogSanitizer.has_secrets(issue_body):
+        logger.error("❌ 检测到可能的敏感信息泄漏，终止上报！")
+        for issue in LogSanitizer.validate(issue_body):
+            logger.error(f"  - {issue}")
         return
 
     # ========== 第6步：调用 GitHub API ==========
     url = f"https://api.github.com/repos/{REPO}/issues"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json",
-        "Content-Type": "application/json"
-    }
     data = {
         "title": title,
         "body": issue_body,
         "labels": ["auto-fix", "security-sanitized"]
     }
 
+    reported = False
     try:
-        print("📤 正在创建 GitHub Issue...", flush=True)
-        resp = requests.post(url, headers=headers, json=data, timeout=30)
+        logger.info("📤 正在创建 GitHub Issue...")
+        resp = GITHUB_SESSION.post(url, data=json_dumps(data), timeout=30)
         resp.raise_for_status()
         
         result = resp.json()
         issue_url = result.get("html_url", "")
         issue_number = result.get("number", "")
         
-        print(f"✅ 已创建 GitHub Issue: {issue_url}", flush=True)
-        print(f"   Issue 编号: #{issue_number}", flush=True)
-        print("🔒 敏感信息已自动脱敏，可安全公开", flush=True)
-        print("⏳ 等待 GitHub Actions AI 自动修复...", flush=True)
+        reported = True
+        write_state(f"fp_{service}", fingerprint)
+        logger.info(f"✅ 已创建 GitHub Issue: {issue_url}")
+        logger.info(f"   Issue 编号: #{issue_number}")
+        logger.info("🔒 敏感信息已自动脱敏，可安全公开")
+        logger.info("⏳ 等待 GitHub Actions AI 自动修复...")
         
     except requests.exceptions.Timeout:
-        print("❌ 创建 Issue 超时（30秒）", flush=True)
+        logger.error("❌ 创建 Issue 超时（30秒）")
         
     except requests.exceptions.HTTPError as e:
-        print(f"❌ GitHub API 错误: {str(e)}", flush=True)
+        logger.error(f"❌ GitHub API 错误: {str(e)}")
         if hasattr(e, 'response') and e.response is not None:
             try:
                 error_detail = e.response.json()
-                print(f"   错误详情: {error_detail.get('message', 'Unknown')}", flush=True)
+                logger.error(f"   错误详情: {error_detail.get('message', 'Unknown')}")
             except:
-                print(f"   HTTP 状态码: {e.response.status_code}", flush=True)
+                logger.error(f"   HTTP 状态码: {e.response.status_code}")
                 
     except Exception as e:
-        print(f"❌ 创建 Issue 失败: {str(e)}", flush=True)
+        logger.error(f"❌ 创建 Issue 失败: {str(e)}")
+
+    record_report_result(service, reported)
 
 
 if __name__ == "__main__":
-    print("=" * 60, flush=True)
-    print("🚀 Universal Fix 脚本启动", flush=True)
-    print("🔒 已启用日志脱敏功能", flush=True)
-    print("=" * 60, flush=True)
+    logger.info("=" * 60)
+    logger.info("🚀 Universal Fix 脚本启动")
+    logger.info("🔒 已启用日志脱敏功能")
+    logger.info("=" * 60)
     
     if len(sys.argv) > 1:
         service_name = sys.argv[1]
-        print(f"目标服务: {service_name}", flush=True)
+        logger.info(f"目标服务: {service_name}")
         collect_and_report(service_name)
     else:
-        print("❌ 错误: 缺少服务名参数", flush=True)
-        print("用法: python3 /home/universal_fix.py <服务名>", flush=True)
-        print(f"服务名可选: {', '.join(PROJECTS.keys())}", flush=True)
+        logger.error("❌ 错误: 缺少服务名参数")
+        logger.info("用法: python3 /home/universal_fix.py <服务名>")
+        logger.info(f"服务名可选: {', '.join(PROJECTS.keys())}")
         sys.exit(1)